@@ -8,6 +8,8 @@ class CoreConfig(AppConfig):
     name = 'core'
 
     def ready(self):
+        from . import signals  # noqa: F401
+
         if os.getenv('DJANGO_RUN_SCHEDULER', '1') != '1':
             return
         blocked_cmds = {'makemigrations', 'migrate', 'collectstatic', 'test', 'shell'}
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pathlib import Path
 import os
 from cryptography.fernet import Fernet
@@ -15,9 +16,17 @@ def _ensure_key_file(path: Path) -> bytes:
     return path.read_bytes()
 
 
+@lru_cache(maxsize=1)
+def _cipher_for(path: str) -> Fernet:
+    return Fernet(_ensure_key_file(Path(path)))
+
+
 def get_cipher() -> Fernet:
-    key = _ensure_key_file(settings.ENCRYPTION_KEY_FILE)
-    return Fernet(key)
+    return _cipher_for(str(settings.ENCRYPTION_KEY_FILE))
+
+
+def clear_cipher_cache() -> None:
+    _cipher_for.cache_clear()
 
 
 def encrypt_password(raw_password: str) -> bytes:
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.5 on 2026-10-15 05:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="querystat",
+            index=models.Index(
+                fields=["snapshot", "-total_time_ms"], name="querystat_snapshot_total"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="setupstate",
+            index=models.Index(
+                condition=models.Q(("ready", True)),
+                fields=["ready"],
+                name="setupstate_ready_true",
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.5 on 2026-10-15 11:40
+
+from django.db import migrations, models
+
+
+def backfill_is_select(apps, schema_editor):
+    QueryStat = apps.get_model("core", "QueryStat")
+    QueryStat.objects.filter(query_norm__iregex=r"^\s*select").update(is_select=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0002_setupstate_querystat_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="querystat",
+            name="is_select",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(backfill_is_select, migrations.RunPython.noop),
+    ]
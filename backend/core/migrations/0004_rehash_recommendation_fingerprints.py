@@ -0,0 +1,57 @@
+import hashlib
+
+from django.db import migrations
+
+INDEX_TITLE_PREFIX = "Index opportunity for query "
+
+
+def _sha256(value):
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def _blake2b(value):
+    return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+
+def _fingerprint_key(rec):
+    if rec.type == "read_replica":
+        return f"{rec.instance_id}:read_replica"
+    if rec.type == "index" and rec.title.startswith(INDEX_TITLE_PREFIX):
+        return f"{rec.instance_id}:{rec.title[len(INDEX_TITLE_PREFIX):]}"
+    return None
+
+
+def _rehash(apps, old_hash, new_hash):
+    Recommendation = apps.get_model("core", "Recommendation")
+
+    for rec in Recommendation.objects.order_by("id").iterator():
+        key = _fingerprint_key(rec)
+        if key is None or rec.fingerprint != old_hash(key):
+            continue
+        new_fingerprint = new_hash(key)
+        if Recommendation.objects.filter(
+            instance_id=rec.instance_id, fingerprint=new_fingerprint
+        ).exists():
+            rec.delete()
+            continue
+        rec.fingerprint = new_fingerprint
+        rec.save(update_fields=["fingerprint"])
+
+
+def sha256_to_blake2b(apps, schema_editor):
+    _rehash(apps, _sha256, _blake2b)
+
+
+def blake2b_to_sha256(apps, schema_editor):
+    _rehash(apps, _blake2b, _sha256)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0003_querystat_is_select"),
+    ]
+
+    operations = [
+        migrations.RunPython(sha256_to_blake2b, blake2b_to_sha256),
+    ]
@@ -20,6 +20,15 @@ class SetupState(models.Model):
     ready = models.BooleanField(default=False)
     last_checked_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['ready'],
+                condition=models.Q(ready=True),
+                name='setupstate_ready_true',
+            ),
+        ]
+
 
 class Snapshot(models.Model):
     instance = models.ForeignKey(Instance, on_delete=models.CASCADE)
@@ -30,6 +39,7 @@ class QueryStat(models.Model):
     snapshot = models.ForeignKey(Snapshot, on_delete=models.CASCADE, related_name='query_stats')
     queryid = models.CharField(max_length=128)
     query_norm = models.TextField()
+    is_select = models.BooleanField(default=False)
     calls = models.BigIntegerField(default=0)
     total_time_ms = models.FloatField(default=0)
     mean_time_ms = models.FloatField(default=0)
@@ -39,6 +49,11 @@ class QueryStat(models.Model):
     temp_blks_written = models.BigIntegerField(default=0)
     wal_bytes = models.BigIntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['snapshot', '-total_time_ms'], name='querystat_snapshot_total'),
+        ]
+
 
 class QueryAnalysis(models.Model):
     queryid = models.CharField(max_length=128)
@@ -1,49 +1,101 @@
 import hashlib
 import re
-import psycopg
+import threading
+from collections.abc import Callable
+from psycopg.conninfo import make_conninfo
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool, PoolTimeout
 from django.conf import settings
 
 
-READINESS_CHECKS = {
-    'server_version': 'SHOW server_version;',
-    'server_version_num': 'SHOW server_version_num;',
-    'shared_preload_libraries': 'SHOW shared_preload_libraries;',
-    'available': "SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name='pg_stat_statements') AS available;",
-    'created': "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname='pg_stat_statements') AS created;",
-    'has_view': "SELECT to_regclass('public.pg_stat_statements') IS NOT NULL AS has_view;",
-}
+_LITERAL_RE = re.compile(r"'(?:''|[^'])*'|\b\d+\b")
 
-PARAM_CHECKS = [
-    'SHOW pg_stat_statements.track;',
-    'SHOW pg_stat_statements.max;',
-    'SHOW pg_stat_statements.save;',
-    'SHOW pg_stat_statements.track_utility;',
-]
+PARAM_CHECKS = (
+    'pg_stat_statements.track',
+    'pg_stat_statements.max',
+    'pg_stat_statements.save',
+    'pg_stat_statements.track_utility',
+)
 
+SETUP_CHECK_SQL = """
+SELECT current_setting('server_version') AS server_version,
+       current_setting('server_version_num')::int AS server_version_num,
+       current_setting('shared_preload_libraries') AS shared_preload_libraries,
+       EXISTS (SELECT 1 FROM pg_available_extensions WHERE name='pg_stat_statements') AS available,
+       EXISTS (SELECT 1 FROM pg_extension WHERE extname='pg_stat_statements') AS created,
+       to_regclass('public.pg_stat_statements') IS NOT NULL AS has_view,
+       current_setting('pg_stat_statements.track', true) AS "pg_stat_statements.track",
+       current_setting('pg_stat_statements.max', true) AS "pg_stat_statements.max",
+       current_setting('pg_stat_statements.save', true) AS "pg_stat_statements.save",
+       current_setting('pg_stat_statements.track_utility', true) AS "pg_stat_statements.track_utility";
+"""
 
-def get_connection(instance, password: str):
-    return psycopg.connect(
+
+_POOLS: dict[int, ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _build_pool(instance, password: str) -> ConnectionPool:
+    conninfo = make_conninfo(
         host=instance.host,
         port=instance.port,
         dbname=instance.dbname,
         user=instance.user,
         password=password,
         sslmode=instance.ssl_mode,
-        row_factory=dict_row,
+        connect_timeout=settings.PG_CONNECT_TIMEOUT_SECONDS,
+    )
+    return ConnectionPool(
+        conninfo,
+        min_size=1,
+        max_size=4,
+        max_idle=300,
+        timeout=settings.PG_CONNECT_TIMEOUT_SECONDS,
+        kwargs={'row_factory': dict_row},
+        check=ConnectionPool.check_connection,
+        name=f'instance-{instance.id}',
+        open=True,
     )
 
 
+def get_pool(instance, password: str | Callable[[], str]) -> ConnectionPool:
+    with _POOLS_LOCK:
+        pool = _POOLS.get(instance.id)
+    if pool is not None:
+        return pool
+
+    if callable(password):
+        password = password()
+    pool = _build_pool(instance, password)
+    try:
+        pool.wait(timeout=settings.PG_CONNECT_TIMEOUT_SECONDS)
+    except PoolTimeout:
+        pool.close()
+        raise
+    with _POOLS_LOCK:
+        existing = _POOLS.setdefault(instance.id, pool)
+    if existing is not pool:
+        pool.close()
+    return existing
+
+
+def close_pool(instance_id: int) -> None:
+    with _POOLS_LOCK:
+        pool = _POOLS.pop(instance_id, None)
+    if pool is not None:
+        pool.close()
+
+
+def setup_cache_key(instance_id: int) -> str:
+    return f'setup:{instance_id}'
+
+
 def check_setup(conn):
-    out = {}
     with conn.cursor() as cur:
-        for key, sql in READINESS_CHECKS.items():
-            cur.execute(sql)
-            row = cur.fetchone()
-            if isinstance(row, dict):
-                out[key] = next(iter(row.values()))
-            else:
-                out[key] = row[0]
+        cur.execute(SETUP_CHECK_SQL)
+        row = cur.fetchone()
+    out = {key: value for key, value in row.items() if key not in PARAM_CHECKS}
+    params = {key: row[key] for key in PARAM_CHECKS if row[key] is not None}
 
     preload = str(out.get('shared_preload_libraries', ''))
     preload_ok = 'pg_stat_statements' in [s.strip() for s in preload.split(',') if s.strip()]
@@ -57,15 +109,6 @@ def check_setup(conn):
     elif not out['created']:
         status = 'NEEDS_CREATE_EXTENSION'
 
-    params = {}
-    with conn.cursor() as cur:
-        for sql in PARAM_CHECKS:
-            try:
-                cur.execute(sql)
-                params[sql.split()[1].strip(';')] = cur.fetchone()[0]
-            except Exception:
-                conn.rollback()
-
     return {
         'status': status,
         'ready': ready,
@@ -105,7 +148,7 @@ def _resolve_stat_columns(conn):
     }
 
 
-def collect_top_queries(conn, limit=200, min_calls=0, min_total_time_ms=0):
+def iter_top_queries(conn, limit=200, min_calls=0, min_total_time_ms=0, chunk_size=100):
     stat_cols = _resolve_stat_columns(conn)
     time_cols = stat_cols['time']
     available = stat_cols['available']
@@ -114,7 +157,9 @@ def collect_top_queries(conn, limit=200, min_calls=0, min_total_time_ms=0):
         return column if column in available else f'0 AS {column}'
 
     sql = f"""
-    SELECT queryid::text AS queryid, query, calls,
+    SELECT queryid::text AS queryid,
+           ltrim(regexp_replace(query, E'[ \\t\\n\\r]+', ' ', 'g')) AS query,
+           calls,
            {time_cols['total_time']} AS total_time,
            {time_cols['mean_time']} AS mean_time,
            rows,
@@ -124,41 +169,39 @@ def collect_top_queries(conn, limit=200, min_calls=0, min_total_time_ms=0):
            COALESCE({stat_or_zero('wal_bytes')},0) AS wal_bytes
     FROM pg_stat_statements
     WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+      AND calls >= %s
+      AND {time_cols['total_time']} >= %s
+      AND NOT upper(ltrim(query, E' \\t\\n\\r')) LIKE ANY (ARRAY['BEGIN%%', 'COMMIT%%', 'SET %%', 'SHOW%%', 'ROLLBACK%%'])
     ORDER BY {time_cols['total_time']} DESC
-    LIMIT %s;
+    LIMIT %s
     """
-    cleaned = []
-    with conn.cursor() as cur:
-        cur.execute(sql, (limit,))
-        for row in cur.fetchall():
-            if min_calls and row['calls'] < min_calls:
-                continue
-            if min_total_time_ms and row['total_time'] < min_total_time_ms:
-                continue
+    with conn.transaction(), conn.cursor(name='top_queries') as cur:
+        cur.itersize = chunk_size
+        cur.execute(sql, (min_calls, min_total_time_ms, limit))
+        for row in cur:
             query_text = normalize_query(row['query'])
-            cleaned.append(
-                {
-                    'queryid': row['queryid'],
-                    'query_norm': query_text if not settings.STORE_FULL_QUERY_TEXT else row['query'],
-                    'calls': row['calls'],
-                    'total_time_ms': row['total_time'],
-                    'mean_time_ms': row['mean_time'],
-                    'rows': row['rows'],
-                    'shared_blks_read': row['shared_blks_read'],
-                    'shared_blks_hit': row['shared_blks_hit'],
-                    'temp_blks_written': row['temp_blks_written'],
-                    'wal_bytes': row['wal_bytes'],
-                }
-            )
-    return cleaned
+            yield {
+                'queryid': row['queryid'],
+                'query_norm': query_text if not settings.STORE_FULL_QUERY_TEXT else row['query'],
+                'is_select': is_select_query(query_text),
+                'calls': row['calls'],
+                'total_time_ms': row['total_time'],
+                'mean_time_ms': row['mean_time'],
+                'rows': row['rows'],
+                'shared_blks_read': row['shared_blks_read'],
+                'shared_blks_hit': row['shared_blks_hit'],
+                'temp_blks_written': row['temp_blks_written'],
+                'wal_bytes': row['wal_bytes'],
+            }
 
 
 def normalize_query(query: str) -> str:
-    compact = re.sub(r'\s+', ' ', query).strip()
-    compact = re.sub(r"'(?:''|[^'])*'", '?', compact)
-    compact = re.sub(r'\b\d+\b', '?', compact)
-    return compact
+    return _LITERAL_RE.sub('?', query.strip())
+
+
+def is_select_query(query_norm: str) -> bool:
+    return bool(query_norm) and query_norm[0] in 'sS' and query_norm[:6].lower() == 'select'
 
 
 def fingerprint(queryid: str, instance_id: int) -> str:
-    return hashlib.sha256(f'{instance_id}:{queryid}'.encode()).hexdigest()
+    return hashlib.blake2b(f'{instance_id}:{queryid}'.encode(), digest_size=16).hexdigest()
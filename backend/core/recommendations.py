@@ -1,31 +1,29 @@
 import hashlib
 from typing import Iterable
 
-from .models import Recommendation, Snapshot, QueryStat, Instance
+from django.db.models import Q, Sum
+
+from .models import Recommendation, Snapshot, QueryStat
 from .postgres import fingerprint
 
+_SELECT_FILTER = Q(is_select=True)
+
 
-def _upsert(instance: Instance, fingerprint_value: str, **fields):
+def _upsert(instance_id: int, fingerprint_value: str, **fields):
     Recommendation.objects.update_or_create(
-        instance=instance,
+        instance_id=instance_id,
         fingerprint=fingerprint_value,
         defaults=fields,
     )
 
 
-def _is_select(query_norm: str) -> bool:
-    if not query_norm:
-        return False
-    return query_norm.lstrip().lower().startswith('select')
-
-
 def _read_replica_fingerprint(instance_id: int) -> str:
-    return hashlib.sha256(f'{instance_id}:read_replica'.encode()).hexdigest()
+    return hashlib.blake2b(f'{instance_id}:read_replica'.encode(), digest_size=16).hexdigest()
 
 
 def _index_candidates(stats: Iterable[QueryStat]):
     for stat in stats:
-        if not _is_select(stat.query_norm):
+        if not stat.is_select:
             continue
         if stat.calls < 25:
             continue
@@ -35,17 +33,21 @@ def _index_candidates(stats: Iterable[QueryStat]):
 
 
 def generate_recommendations(snapshot: Snapshot):
-    stats = list(snapshot.query_stats.all())
-    if not stats:
+    stats_qs = snapshot.query_stats.all()
+    agg = stats_qs.aggregate(
+        total=Sum('total_time_ms'),
+        select_total=Sum('total_time_ms', filter=_SELECT_FILTER),
+    )
+    if agg['total'] is None:
         return
 
-    total_time = sum(stat.total_time_ms for stat in stats)
-    select_time = sum(stat.total_time_ms for stat in stats if _is_select(stat.query_norm))
+    total_time = agg['total']
+    select_time = agg['select_total'] or 0
     select_ratio = select_time / total_time if total_time > 0 else 0
 
     if total_time >= 10_000 and select_ratio >= 0.8:
         _upsert(
-            snapshot.instance,
+            snapshot.instance_id,
             _read_replica_fingerprint(snapshot.instance_id),
             type='read_replica',
             title='Read-heavy workload detected',
@@ -59,10 +61,13 @@ def generate_recommendations(snapshot: Snapshot):
             status='open',
         )
 
-    top_stats = sorted(stats, key=lambda row: row.total_time_ms, reverse=True)[:5]
+    top_stats = (
+        stats_qs.only('queryid', 'is_select', 'calls', 'mean_time_ms', 'total_time_ms')
+        .order_by('-total_time_ms')[:5]
+    )
     for stat in _index_candidates(top_stats):
         _upsert(
-            snapshot.instance,
+            snapshot.instance_id,
             fingerprint(stat.queryid, snapshot.instance_id),
             type='index',
             title=f'Index opportunity for query {stat.queryid}',
@@ -1,50 +1,141 @@
+import logging
 import threading
 import time
-import logging
+from contextlib import closing
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.background import BackgroundScheduler
 from django.conf import settings
+from django.db import close_old_connections
 from django.utils import timezone
 from cryptography.fernet import InvalidToken
-from .models import Instance, SetupState, Snapshot, QueryStat
+from .models import Instance, SetupState
 from .crypto import decrypt_password
-from .postgres import get_connection, collect_top_queries
+from .postgres import get_pool, iter_top_queries
 from .recommendations import generate_recommendations
+from .storage import save_snapshot
 
 logger = logging.getLogger(__name__)
-_started = False
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_jobs_lock = threading.Lock()
+# get_pool only asks for the password when it has to build a pool, so this
+# mostly saves decrypts while an unreachable instance is retried every run.
+_PW_CACHE: dict[int, tuple[float, str]] = {}
+_PW_CACHE_TTL = 300
+
+
+def _interval() -> int:
+    return max(settings.COLLECTOR_INTERVAL_SECONDS, 10)
+
+
+def _job_id(instance_id: int) -> str:
+    return f'inst-{instance_id}'
+
+
+def _safe_collect(instance_id: int):
+    close_old_connections()
+    try:
+        instance = (
+            Instance.objects.filter(pk=instance_id, setupstate__ready=True)
+            .only('id', 'host', 'port', 'dbname', 'user', 'password_enc', 'ssl_mode')
+            .first()
+        )
+        if instance is None:
+            unschedule_instance(instance_id)
+            return
+        try:
+            _collect_instance(instance)
+        except Exception as exc:
+            logger.exception('collection failed for instance %s: %s', instance_id, exc)
+        SetupState.objects.filter(instance_id=instance_id).update(last_checked_at=timezone.now())
+    finally:
+        close_old_connections()
+
+
+def _sync_jobs():
+    close_old_connections()
+    try:
+        ready_ids = set(SetupState.objects.filter(ready=True).values_list('instance_id', flat=True))
+    finally:
+        close_old_connections()
+    for instance_id in ready_ids:
+        schedule_instance(instance_id)
+    for job in _scheduler.get_jobs():
+        if job.func is _safe_collect and job.args[0] not in ready_ids:
+            job.remove()
+
 
+def _get_password(instance: Instance) -> str:
+    now = time.monotonic()
+    cached = _PW_CACHE.get(instance.id)
+    if cached and now - cached[0] < _PW_CACHE_TTL:
+        return cached[1]
+    password = decrypt_password(bytes(instance.password_enc))
+    _PW_CACHE[instance.id] = (now, password)
+    return password
 
-def _tick():
-    while True:
-        interval = max(settings.COLLECTOR_INTERVAL_SECONDS, 10)
-        for state in SetupState.objects.filter(ready=True).select_related('instance'):
-            try:
-                _collect_instance(state.instance)
-            except Exception as exc:
-                logger.exception('collection failed for instance %s: %s', state.instance_id, exc)
-            state.last_checked_at = timezone.now()
-            state.save(update_fields=['last_checked_at'])
-        time.sleep(interval)
+
+def forget_password(instance_id: int):
+    _PW_CACHE.pop(instance_id, None)
 
 
 def _collect_instance(instance: Instance):
     try:
-        password = decrypt_password(bytes(instance.password_enc))
+        pool = get_pool(instance, lambda: _get_password(instance))
     except InvalidToken:
         logger.warning('collection skipped for instance %s: invalid credentials', instance.id)
         return
-    conn = get_connection(instance, password)
-    rows = collect_top_queries(conn)
-    conn.close()
-
-    snapshot = Snapshot.objects.create(instance=instance)
-    QueryStat.objects.bulk_create([QueryStat(snapshot=snapshot, **row) for row in rows])
+    with pool.connection() as conn, closing(iter_top_queries(conn)) as rows:
+        snapshot, _ = save_snapshot(instance, rows)
     generate_recommendations(snapshot)
 
 
-def start_scheduler():
-    global _started
-    if _started:
+def schedule_instance(instance_id: int):
+    if _scheduler is None:
+        return
+    with _jobs_lock:
+        if _scheduler.get_job(_job_id(instance_id)) is not None:
+            return
+        _scheduler.add_job(
+            _safe_collect,
+            'interval',
+            args=[instance_id],
+            seconds=_interval(),
+            jitter=_interval() // 10,
+            id=_job_id(instance_id),
+            next_run_time=timezone.now(),
+        )
+
+
+def unschedule_instance(instance_id: int):
+    if _scheduler is None:
         return
-    _started = True
-    thread = threading.Thread(target=_tick, daemon=True)
-    thread.start()
+    try:
+        _scheduler.remove_job(_job_id(instance_id))
+    except JobLookupError:
+        pass
+
+
+def _build_scheduler() -> BackgroundScheduler:
+    return BackgroundScheduler(
+        executors={'default': ThreadPoolExecutor(max(settings.COLLECTOR_WORKERS, 1))},
+        job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': None},
+        timezone='UTC',
+    )
+
+
+def start_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            return
+        _scheduler = _build_scheduler()
+        _scheduler.add_job(
+            _sync_jobs,
+            'interval',
+            seconds=_interval(),
+            id='sync-jobs',
+            next_run_time=timezone.now(),
+        )
+        _scheduler.start()
@@ -45,8 +45,21 @@ class QueryStatSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class SnapshotListSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Snapshot
+        fields = ['id', 'instance', 'captured_at']
+
+
 class SnapshotSerializer(serializers.ModelSerializer):
-    query_stats = QueryStatSerializer(many=True)
+    query_stats = serializers.SerializerMethodField()
+
+    def get_query_stats(self, obj):
+        stats = obj.query_stats.order_by('-total_time_ms')
+        limit = self.context.get('query_stats_limit')
+        if limit is not None:
+            stats = stats[:limit]
+        return QueryStatSerializer(stats, many=True).data
 
     class Meta:
         model = Snapshot
@@ -0,0 +1,31 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Instance, SetupState
+from .postgres import close_pool, setup_cache_key
+from .scheduler import forget_password, schedule_instance, unschedule_instance
+
+
+@receiver(post_save, sender=Instance)
+@receiver(post_delete, sender=Instance)
+def drop_instance_caches(sender, instance, **kwargs):
+    close_pool(instance.id)
+    forget_password(instance.id)
+    cache.delete(setup_cache_key(instance.id))
+
+
+@receiver(post_save, sender=SetupState)
+def sync_collection_job(sender, instance, **kwargs):
+    instance_id = instance.instance_id
+    if instance.ready:
+        transaction.on_commit(lambda: schedule_instance(instance_id))
+    else:
+        transaction.on_commit(lambda: unschedule_instance(instance_id))
+
+
+@receiver(post_delete, sender=SetupState)
+def drop_collection_job(sender, instance, **kwargs):
+    instance_id = instance.instance_id
+    transaction.on_commit(lambda: unschedule_instance(instance_id))
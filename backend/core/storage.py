@@ -0,0 +1,53 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Instance, QueryStat, Snapshot
+
+QUERYSTAT_COPY_COLUMNS = (
+    'queryid',
+    'query_norm',
+    'is_select',
+    'calls',
+    'total_time_ms',
+    'mean_time_ms',
+    'rows',
+    'shared_blks_read',
+    'shared_blks_hit',
+    'temp_blks_written',
+    'wal_bytes',
+)
+
+
+def _copy_query_stats(snapshot: Snapshot, rows) -> None:
+    table = connection.ops.quote_name(QueryStat._meta.db_table)
+    columns = ', '.join(
+        connection.ops.quote_name(QueryStat._meta.get_field(name).column)
+        for name in ('snapshot', *QUERYSTAT_COPY_COLUMNS)
+    )
+    with connection.cursor() as cur:
+        with cur.copy(f'COPY {table} ({columns}) FROM STDIN') as copy:
+            for row in rows:
+                copy.write_row((snapshot.id, *(row[name] for name in QUERYSTAT_COPY_COLUMNS)))
+
+
+def save_query_stats(snapshot: Snapshot, rows) -> int:
+    rows = iter(rows)
+    batch_size = max(settings.QUERYSTAT_BULK_BATCH_SIZE, 1)
+    count = 0
+    while batch := list(islice(rows, batch_size)):
+        if connection.vendor == 'postgresql':
+            _copy_query_stats(snapshot, batch)
+        else:
+            QueryStat.objects.bulk_create([QueryStat(snapshot=snapshot, **row) for row in batch])
+        count += len(batch)
+    return count
+
+
+def save_snapshot(instance: Instance, rows) -> tuple[Snapshot, int]:
+    rows = list(rows)
+    with transaction.atomic():
+        snapshot = Snapshot.objects.create(instance=instance)
+        count = save_query_stats(snapshot, rows)
+    return snapshot, count
@@ -1,5 +1,24 @@
-from django.test import TestCase
-from .postgres import normalize_query
+import hashlib
+import importlib
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+from django.apps import apps
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from apscheduler.schedulers.background import BackgroundScheduler
+from psycopg.errors import QueryCanceled
+from psycopg_pool import PoolTimeout
+from rest_framework.test import APITestCase
+from . import scheduler
+from .models import Instance, QueryStat, Recommendation, SetupState, Snapshot
+from .crypto import clear_cipher_cache, decrypt_password, encrypt_password, get_cipher
+from .postgres import _POOLS, check_setup, close_pool, fingerprint, get_pool, is_select_query, normalize_query
+from .recommendations import generate_recommendations
+from .storage import save_query_stats, save_snapshot
 
 
 class NormalizeQueryTests(TestCase):
@@ -8,3 +27,552 @@ class NormalizeQueryTests(TestCase):
             normalize_query("SELECT * FROM users WHERE id = 42 AND email = 'x@y.com'"),
             'SELECT * FROM users WHERE id = ? AND email = ?'
         )
+
+    def test_numbers_inside_strings_are_not_replaced_twice(self):
+        self.assertEqual(
+            normalize_query("UPDATE t1 SET note = 'room 101' WHERE id IN (7, 8) "),
+            'UPDATE t1 SET note = ? WHERE id IN (?, ?)'
+        )
+
+
+class IsSelectQueryTests(TestCase):
+    def test_prefix_check_on_normalized_text(self):
+        self.assertTrue(is_select_query(normalize_query('select * from t where id = 1')))
+        self.assertTrue(is_select_query('SELECT ?'))
+        self.assertFalse(is_select_query('SET search_path = ?'))
+        self.assertFalse(is_select_query('sel'))
+        self.assertFalse(is_select_query(''))
+
+
+class CipherCacheTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(clear_cipher_cache)
+        clear_cipher_cache()
+
+    def test_cipher_reused_for_same_key_file(self):
+        with override_settings(ENCRYPTION_KEY_FILE=Path(self.tmpdir.name) / 'key.bin'):
+            self.assertIs(get_cipher(), get_cipher())
+            self.assertEqual(decrypt_password(encrypt_password('secret')), 'secret')
+
+    def test_cipher_follows_key_file_setting(self):
+        with override_settings(ENCRYPTION_KEY_FILE=Path(self.tmpdir.name) / 'a.bin'):
+            first = get_cipher()
+        with override_settings(ENCRYPTION_KEY_FILE=Path(self.tmpdir.name) / 'b.bin'):
+            self.assertIsNot(get_cipher(), first)
+
+
+class _FakeCursor:
+    def __init__(self, row):
+        self.row = row
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+    def fetchone(self):
+        return self.row
+
+
+class _FakeConnection:
+    def __init__(self, row):
+        self.cur = _FakeCursor(row)
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self.cur
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class CheckSetupTests(TestCase):
+    def test_single_round_trip_splits_checks_and_params(self):
+        conn = _FakeConnection(
+            {
+                'server_version': '16.2',
+                'server_version_num': 160002,
+                'shared_preload_libraries': 'auto_explain, pg_stat_statements',
+                'available': True,
+                'created': True,
+                'has_view': True,
+                'pg_stat_statements.track': 'top',
+                'pg_stat_statements.max': '5000',
+                'pg_stat_statements.save': None,
+                'pg_stat_statements.track_utility': 'on',
+            }
+        )
+        info = check_setup(conn)
+
+        self.assertEqual(len(conn.cur.executed), 1)
+        self.assertEqual(info['status'], 'READY')
+        self.assertEqual(info['pg_version_num'], 160002)
+        self.assertNotIn('pg_stat_statements.track', info['checks'])
+        self.assertEqual(
+            info['params'],
+            {
+                'pg_stat_statements.track': 'top',
+                'pg_stat_statements.max': '5000',
+                'pg_stat_statements.track_utility': 'on',
+            },
+        )
+
+    def test_missing_extension_settings_do_not_roll_back(self):
+        conn = _FakeConnection(
+            {
+                'server_version': '16.2',
+                'server_version_num': 160002,
+                'shared_preload_libraries': '',
+                'available': True,
+                'created': False,
+                'has_view': False,
+                'pg_stat_statements.track': None,
+                'pg_stat_statements.max': None,
+                'pg_stat_statements.save': None,
+                'pg_stat_statements.track_utility': None,
+            }
+        )
+        info = check_setup(conn)
+
+        self.assertEqual(conn.rollbacks, 0)
+        self.assertEqual(len(conn.cur.executed), 1)
+        self.assertEqual(info['status'], 'NEEDS_PRELOAD')
+        self.assertEqual(info['params'], {})
+
+
+class GetPoolTests(TestCase):
+    def setUp(self):
+        self.instance = Instance(id=987, host='db.invalid', dbname='app', user='app')
+        self.addCleanup(_POOLS.pop, self.instance.id, None)
+
+    @mock.patch('core.postgres.ConnectionPool')
+    def test_failed_first_connect_closes_pool_and_is_not_cached(self, pool_cls):
+        pool_cls.return_value.wait.side_effect = PoolTimeout('no connection')
+
+        with self.assertRaises(PoolTimeout):
+            get_pool(self.instance, 'secret')
+
+        pool_cls.return_value.close.assert_called_once()
+        self.assertNotIn(self.instance.id, _POOLS)
+
+    @mock.patch('core.postgres.ConnectionPool')
+    def test_pool_reused_until_closed(self, pool_cls):
+        pool = get_pool(self.instance, 'secret')
+        self.assertIs(get_pool(self.instance, 'secret'), pool)
+        self.assertEqual(pool_cls.call_count, 1)
+
+        close_pool(self.instance.id)
+        pool.close.assert_called_once()
+        self.assertNotIn(self.instance.id, _POOLS)
+
+    @mock.patch('core.postgres.ConnectionPool')
+    def test_password_source_only_called_when_building_a_pool(self, pool_cls):
+        password = mock.Mock(return_value='secret')
+
+        get_pool(self.instance, password)
+        get_pool(self.instance, password)
+
+        password.assert_called_once_with()
+
+
+def _stat_row(i):
+    return {
+        'queryid': str(i),
+        'query_norm': 'SELECT ?',
+        'is_select': True,
+        'calls': i,
+        'total_time_ms': float(i),
+        'mean_time_ms': 1.0,
+        'rows': i,
+        'shared_blks_read': 0,
+        'shared_blks_hit': 0,
+        'temp_blks_written': 0,
+        'wal_bytes': 0,
+    }
+
+
+class SaveQueryStatsTests(TestCase):
+    def setUp(self):
+        self.instance = Instance.objects.create(
+            name='local', host='localhost', dbname='app', user='app', password_enc=b'x'
+        )
+
+    @override_settings(QUERYSTAT_BULK_BATCH_SIZE=2)
+    def test_rows_stored_against_snapshot_in_batches(self):
+        snapshot = Snapshot.objects.create(instance=self.instance)
+
+        self.assertEqual(save_query_stats(snapshot, (_stat_row(i) for i in range(3))), 3)
+        self.assertEqual(snapshot.query_stats.count(), 3)
+
+    def test_snapshot_is_written_only_after_the_read_finishes(self):
+        def rows():
+            for i in range(3):
+                self.assertFalse(Snapshot.objects.exists())
+                yield _stat_row(i)
+
+        snapshot, count = save_snapshot(self.instance, rows())
+
+        self.assertEqual(count, 3)
+        self.assertEqual(snapshot.query_stats.count(), 3)
+
+    @override_settings(QUERYSTAT_BULK_BATCH_SIZE=2)
+    def test_failed_read_leaves_no_snapshot(self):
+        def rows():
+            yield from (_stat_row(i) for i in range(3))
+            raise OSError('connection lost')
+
+        with self.assertRaises(OSError):
+            save_snapshot(self.instance, rows())
+
+        self.assertFalse(Snapshot.objects.filter(instance=self.instance).exists())
+        self.assertFalse(QueryStat.objects.exists())
+
+
+class GenerateRecommendationsTests(TestCase):
+    def test_read_heavy_snapshot_gets_replica_and_index_recommendations(self):
+        instance = Instance.objects.create(
+            name='local', host='localhost', dbname='app', user='app', password_enc=b'x'
+        )
+        snapshot = Snapshot.objects.create(instance=instance)
+        QueryStat.objects.bulk_create(
+            [
+                QueryStat(
+                    snapshot=snapshot,
+                    queryid='1',
+                    query_norm='SELECT * FROM orders WHERE id = ?',
+                    is_select=True,
+                    calls=100,
+                    total_time_ms=9_000,
+                    mean_time_ms=90,
+                ),
+                QueryStat(
+                    snapshot=snapshot,
+                    queryid='2',
+                    query_norm='UPDATE orders SET status = ?',
+                    calls=100,
+                    total_time_ms=1_000,
+                    mean_time_ms=10,
+                ),
+            ]
+        )
+
+        generate_recommendations(snapshot)
+
+        types = sorted(Recommendation.objects.filter(instance=instance).values_list('type', flat=True))
+        self.assertEqual(types, ['index', 'read_replica'])
+
+
+class RehashFingerprintsMigrationTests(TestCase):
+    def test_sha256_fingerprints_are_rewritten_from_titles_without_duplicates(self):
+        migration = importlib.import_module('core.migrations.0004_rehash_recommendation_fingerprints')
+        instance = Instance.objects.create(
+            name='local', host='localhost', dbname='app', user='app', password_enc=b'x'
+        )
+
+        def legacy(key):
+            return hashlib.sha256(f'{instance.id}:{key}'.encode()).hexdigest()
+
+        def index_rec(queryid, fingerprint_value):
+            return Recommendation.objects.create(
+                instance=instance,
+                type='index',
+                title=f'Index opportunity for query {queryid}',
+                details='d',
+                confidence='low',
+                fingerprint=fingerprint_value,
+            )
+
+        index_rec('42', legacy('42'))
+        index_rec('43', legacy('43'))
+        index_rec('43', fingerprint('43', instance.id))
+        Recommendation.objects.create(
+            instance=instance,
+            type='read_replica',
+            title='Read-heavy workload detected',
+            details='d',
+            confidence='low',
+            fingerprint=legacy('read_replica'),
+        )
+
+        migration.sha256_to_blake2b(apps, None)
+
+        self.assertEqual(
+            sorted(Recommendation.objects.values_list('fingerprint', flat=True)),
+            sorted(
+                [
+                    fingerprint('42', instance.id),
+                    fingerprint('43', instance.id),
+                    hashlib.blake2b(f'{instance.id}:read_replica'.encode(), digest_size=16).hexdigest(),
+                ]
+            ),
+        )
+
+
+class SchedulerJobTests(TestCase):
+    def setUp(self):
+        background = BackgroundScheduler(timezone='UTC')
+        background.start(paused=True)
+        self.addCleanup(background.shutdown, wait=False)
+        for patcher in (
+            mock.patch.object(scheduler, '_scheduler', background),
+            mock.patch.object(scheduler, 'close_old_connections'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.background = background
+
+    def _instance(self, name):
+        return Instance.objects.create(
+            name=name, host='localhost', dbname='app', user='app', password_enc=b'x'
+        )
+
+    def _job_ids(self):
+        return {job.id for job in self.background.get_jobs()}
+
+    def test_sync_jobs_matches_ready_instances(self):
+        ready = self._instance('ready')
+        stale = self._instance('stale')
+        SetupState.objects.create(instance=ready, ready=True)
+        SetupState.objects.create(instance=stale, ready=False)
+        scheduler.schedule_instance(stale.id)
+
+        scheduler._sync_jobs()
+
+        self.assertEqual(self._job_ids(), {f'inst-{ready.id}'})
+
+    def test_schedule_instance_is_idempotent(self):
+        instance = self._instance('ready')
+        scheduler.schedule_instance(instance.id)
+        scheduler.schedule_instance(instance.id)
+
+        self.assertEqual(self._job_ids(), {f'inst-{instance.id}'})
+
+    def test_concurrent_schedule_calls_add_one_job(self):
+        instance = self._instance('ready')
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def schedule():
+            barrier.wait()
+            try:
+                scheduler.schedule_instance(instance.id)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=schedule) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self._job_ids(), {f'inst-{instance.id}'})
+
+    def test_setup_state_changes_apply_after_commit(self):
+        instance = self._instance('ready')
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            state = SetupState.objects.create(instance=instance, ready=True)
+        self.assertEqual(self._job_ids(), set())
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self._job_ids(), {f'inst-{instance.id}'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            state.ready = False
+            state.save()
+        self.assertEqual(self._job_ids(), set())
+
+
+class PasswordCacheTests(TestCase):
+    def setUp(self):
+        self.instance = Instance.objects.create(
+            name='local', host='localhost', dbname='app', user='app', password_enc=b'x'
+        )
+        self.addCleanup(scheduler.forget_password, self.instance.id)
+        for patcher in (
+            mock.patch.object(scheduler, 'decrypt_password', return_value='secret'),
+            mock.patch.object(scheduler, 'time'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        scheduler.time.monotonic.return_value = 1000.0
+
+    def test_password_decrypted_again_after_ttl(self):
+        self.assertEqual(scheduler._get_password(self.instance), 'secret')
+        scheduler.time.monotonic.return_value += scheduler._PW_CACHE_TTL - 1
+        self.assertEqual(scheduler._get_password(self.instance), 'secret')
+        self.assertEqual(scheduler.decrypt_password.call_count, 1)
+
+        scheduler.time.monotonic.return_value += 1
+        scheduler._get_password(self.instance)
+        self.assertEqual(scheduler.decrypt_password.call_count, 2)
+
+    def test_instance_save_purges_cached_password(self):
+        scheduler._get_password(self.instance)
+        self.assertIn(self.instance.id, scheduler._PW_CACHE)
+
+        self.instance.save()
+
+        self.assertNotIn(self.instance.id, scheduler._PW_CACHE)
+        scheduler._get_password(self.instance)
+        self.assertEqual(scheduler.decrypt_password.call_count, 2)
+
+
+class InstanceApiTestCase(APITestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        key_override = override_settings(ENCRYPTION_KEY_FILE=Path(tmpdir.name) / 'key.bin')
+        key_override.enable()
+        self.addCleanup(key_override.disable)
+        clear_cipher_cache()
+        self.addCleanup(clear_cipher_cache)
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.instance = Instance.objects.create(
+            name='local',
+            host='localhost',
+            dbname='app',
+            user='app',
+            password_enc=encrypt_password('secret'),
+        )
+
+    def _mock_pool(self, get_pool):
+        conn = mock.MagicMock()
+        get_pool.return_value.connection.return_value.__enter__.return_value = conn
+        return conn
+
+
+class InstanceConnectionErrorTests(InstanceApiTestCase):
+    @mock.patch('core.views.get_pool', side_effect=PoolTimeout('timed out'))
+    def test_unreachable_instance_reports_connection_failure(self, get_pool):
+        response = self.client.post(f'/api/instances/{self.instance.id}/check_setup/')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('Could not connect', response.data['detail'])
+
+    @mock.patch('core.views.iter_top_queries', side_effect=QueryCanceled('canceling statement due to statement timeout'))
+    @mock.patch('core.views.get_pool')
+    def test_query_failure_is_not_reported_as_connection_failure(self, get_pool, iter_top_queries):
+        self._mock_pool(get_pool)
+        SetupState.objects.create(instance=self.instance, ready=True)
+
+        response = self.client.post(f'/api/instances/{self.instance.id}/collect/')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertNotIn('Could not connect', response.data['detail'])
+        self.assertIn('statement timeout', response.data['detail'])
+
+
+def _setup_info(ready):
+    return {
+        'status': 'READY' if ready else 'NEEDS_PRELOAD',
+        'ready': ready,
+        'pg_version_num': 160002,
+        'preload_ok': ready,
+        'ext_created': ready,
+    }
+
+
+@mock.patch('core.views.check_setup')
+@mock.patch('core.views.get_pool')
+class CheckSetupCacheTests(InstanceApiTestCase):
+    def _check(self):
+        return self.client.post(f'/api/instances/{self.instance.id}/check_setup/')
+
+    def test_cached_ready_result_skips_pool_and_connection(self, get_pool, check_setup):
+        self._mock_pool(get_pool)
+        check_setup.return_value = _setup_info(ready=True)
+        self._check()
+        get_pool.reset_mock()
+        check_setup.reset_mock()
+
+        response = self._check()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'READY')
+        get_pool.assert_not_called()
+        check_setup.assert_not_called()
+
+    def test_only_ready_results_are_cached(self, get_pool, check_setup):
+        self._mock_pool(get_pool)
+        check_setup.return_value = _setup_info(ready=False)
+
+        self._check()
+        self._check()
+
+        self.assertEqual(get_pool.call_count, 2)
+        self.assertEqual(check_setup.call_count, 2)
+
+    def test_instance_save_invalidates_cached_result(self, get_pool, check_setup):
+        self._mock_pool(get_pool)
+        check_setup.return_value = _setup_info(ready=True)
+        self._check()
+
+        self.instance.host = 'replica.local'
+        self.instance.save()
+        self._check()
+
+        self.assertEqual(get_pool.call_count, 2)
+        self.assertEqual(check_setup.call_count, 2)
+
+
+class SnapshotApiTests(APITestCase):
+    def setUp(self):
+        instance = Instance.objects.create(
+            name='local', host='localhost', dbname='app', user='app', password_enc=b'x'
+        )
+        self.snapshot = Snapshot.objects.create(instance=instance)
+        QueryStat.objects.bulk_create(
+            [
+                QueryStat(snapshot=self.snapshot, queryid=str(i), query_norm='SELECT ?', total_time_ms=i)
+                for i in range(60)
+            ]
+        )
+
+    def test_list_omits_query_stats(self):
+        response = self.client.get('/api/snapshots/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data[0]), {'id', 'instance', 'captured_at'})
+
+    def test_retrieve_returns_top_stats_by_total_time(self):
+        response = self.client.get(f'/api/snapshots/{self.snapshot.id}/')
+
+        self.assertEqual(response.status_code, 200)
+        stats = response.data['query_stats']
+        self.assertEqual(len(stats), 50)
+        self.assertEqual([stat['total_time_ms'] for stat in stats], [float(i) for i in range(59, 9, -1)])
+
+
+class SchedulerWorkerPoolTests(TestCase):
+    @override_settings(COLLECTOR_WORKERS=1)
+    def test_queued_jobs_run_when_instances_outnumber_workers(self):
+        background = scheduler._build_scheduler()
+        collected = []
+        done = threading.Event()
+
+        def slow_collect(instance_id):
+            time.sleep(1.2)
+            collected.append(instance_id)
+            if len(collected) == 3:
+                done.set()
+
+        with mock.patch.object(scheduler, '_scheduler', background), mock.patch.object(
+            scheduler, '_safe_collect', slow_collect
+        ):
+            for instance_id in (1, 2, 3):
+                scheduler.schedule_instance(instance_id)
+            background.start()
+            self.addCleanup(background.shutdown, wait=False)
+            done.wait(timeout=10)
+
+        self.assertEqual(sorted(collected), [1, 2, 3])
@@ -1,18 +1,38 @@
-from django.db import transaction
+from contextlib import closing
+from django.conf import settings
+from django.core.cache import cache
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from cryptography.fernet import InvalidToken
-from .models import Instance, SetupState, Snapshot, QueryStat, Recommendation
+from psycopg import OperationalError
+from psycopg_pool import PoolTimeout
+from .models import Instance, SetupState, Snapshot, Recommendation
 from .serializers import (
     InstanceSerializer,
     SetupStateSerializer,
+    SnapshotListSerializer,
     SnapshotSerializer,
     RecommendationSerializer,
 )
 from .crypto import decrypt_password
-from .postgres import get_connection, check_setup, collect_top_queries
+from .postgres import get_pool, check_setup, iter_top_queries, setup_cache_key
 from .recommendations import generate_recommendations
+from .storage import save_snapshot
+
+
+def _connection_failed():
+    return Response(
+        {'detail': 'Could not connect to the database. Check host, port and credentials.'},
+        status=status.HTTP_409_CONFLICT,
+    )
+
+
+def _query_failed(exc):
+    return Response(
+        {'detail': f'The database reported an error while running the query: {exc}'},
+        status=status.HTTP_409_CONFLICT,
+    )
 
 
 class InstanceViewSet(viewsets.ModelViewSet):
@@ -22,6 +42,11 @@ class InstanceViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def check_setup(self, request, pk=None):
         instance = self.get_object()
+        cache_key = setup_cache_key(instance.id)
+        info = cache.get(cache_key)
+        if info is not None:
+            return Response(info)
+
         try:
             password = decrypt_password(bytes(instance.password_enc))
         except InvalidToken:
@@ -29,8 +54,13 @@ class InstanceViewSet(viewsets.ModelViewSet):
                 {'detail': 'Stored credentials are invalid. Please reset the password.'},
                 status=status.HTTP_409_CONFLICT,
             )
-        conn = get_connection(instance, password)
-        info = check_setup(conn)
+        try:
+            with get_pool(instance, password).connection() as conn:
+                info = check_setup(conn)
+        except PoolTimeout:
+            return _connection_failed()
+        except OperationalError as exc:
+            return _query_failed(exc)
 
         SetupState.objects.update_or_create(
             instance=instance,
@@ -41,7 +71,8 @@ class InstanceViewSet(viewsets.ModelViewSet):
                 'ready': info['ready'],
             },
         )
-        conn.close()
+        if info['ready']:
+            cache.set(cache_key, info, settings.SETUP_CHECK_CACHE_SECONDS)
         return Response(info)
 
     @action(detail=True, methods=['post'])
@@ -58,17 +89,15 @@ class InstanceViewSet(viewsets.ModelViewSet):
                 {'detail': 'Stored credentials are invalid. Please reset the password.'},
                 status=status.HTTP_409_CONFLICT,
             )
-        conn = get_connection(instance, password)
-        rows = collect_top_queries(conn)
-        conn.close()
-
-        with transaction.atomic():
-            snapshot = Snapshot.objects.create(instance=instance)
-            QueryStat.objects.bulk_create(
-                [QueryStat(snapshot=snapshot, **row) for row in rows]
-            )
+        try:
+            with get_pool(instance, password).connection() as conn, closing(iter_top_queries(conn)) as rows:
+                snapshot, row_count = save_snapshot(instance, rows)
+        except PoolTimeout:
+            return _connection_failed()
+        except OperationalError as exc:
+            return _query_failed(exc)
         generate_recommendations(snapshot)
-        return Response({'snapshot_id': snapshot.id, 'rows': len(rows)})
+        return Response({'snapshot_id': snapshot.id, 'rows': row_count})
 
 
 class SetupStateViewSet(viewsets.ReadOnlyModelViewSet):
@@ -77,8 +106,19 @@ class SetupStateViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 class SnapshotViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Snapshot.objects.prefetch_related('query_stats').all().order_by('-captured_at')
+    queryset = Snapshot.objects.all().order_by('-captured_at')
     serializer_class = SnapshotSerializer
+    detail_query_stats_limit = 50
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['query_stats_limit'] = self.detail_query_stats_limit
+        return context
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return SnapshotListSerializer
+        return super().get_serializer_class()
 
 
 class RecommendationViewSet(viewsets.ReadOnlyModelViewSet):
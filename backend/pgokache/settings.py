@@ -67,5 +67,9 @@ STATICFILES_DIRS = [BASE_DIR / 'frontend_dist' / 'assets'] if (BASE_DIR / 'front
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 COLLECTOR_INTERVAL_SECONDS = int(os.getenv('COLLECTOR_INTERVAL_SECONDS', '60'))
+COLLECTOR_WORKERS = int(os.getenv('COLLECTOR_WORKERS', '4'))
+PG_CONNECT_TIMEOUT_SECONDS = int(os.getenv('PG_CONNECT_TIMEOUT_SECONDS', '5'))
+SETUP_CHECK_CACHE_SECONDS = int(os.getenv('SETUP_CHECK_CACHE_SECONDS', '60'))
 ENCRYPTION_KEY_FILE = Path(os.getenv('ENCRYPTION_KEY_FILE', BASE_DIR / '.secrets' / 'key.bin'))
 STORE_FULL_QUERY_TEXT = os.getenv('STORE_FULL_QUERY_TEXT', '0') == '1'
+QUERYSTAT_BULK_BATCH_SIZE = int(os.getenv('QUERYSTAT_BULK_BATCH_SIZE', '100'))
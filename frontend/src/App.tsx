@@ -45,10 +45,13 @@ type QueryStat = {
   wal_bytes: number
 }
 
-type Snapshot = {
+type SnapshotSummary = {
   id: number
   instance: number
   captured_at: string
+}
+
+type Snapshot = SnapshotSummary & {
   query_stats: QueryStat[]
 }
 
@@ -181,13 +184,24 @@ function App() {
     try {
       const res = await fetch(`${API_BASE}/snapshots/`)
       if (!res.ok) throw new Error('Failed to load snapshots.')
-      const data = (await res.json()) as Snapshot[]
-      const next: Record<number, Snapshot> = {}
+      const data = (await res.json()) as SnapshotSummary[]
+      const latest: Record<number, SnapshotSummary> = {}
       data.forEach((snapshot) => {
-        if (!next[snapshot.instance]) {
-          next[snapshot.instance] = snapshot
+        if (!latest[snapshot.instance]) {
+          latest[snapshot.instance] = snapshot
         }
       })
+      const details = await Promise.all(
+        Object.values(latest).map(async (snapshot) => {
+          const detailRes = await fetch(`${API_BASE}/snapshots/${snapshot.id}/`)
+          if (!detailRes.ok) throw new Error('Failed to load snapshot details.')
+          return (await detailRes.json()) as Snapshot
+        })
+      )
+      const next: Record<number, Snapshot> = {}
+      details.forEach((snapshot) => {
+        next[snapshot.instance] = snapshot
+      })
       setSnapshots(next)
     } catch (err) {
       setError(err instanceof Error ? err.message : 'Unable to load snapshots.')